@@ -4,11 +4,24 @@ import time
 import os
 import json
 import threading
+import concurrent.futures
 import re
 import google.generativeai as genai
 from google.api_core import exceptions
 from dotenv import load_dotenv
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    from turbojpeg import TurboJPEG
+    HAS_TURBOJPEG = True
+except ImportError:
+    HAS_TURBOJPEG = False
+
 # Load environment variables
 load_dotenv()
 
@@ -24,10 +37,20 @@ except Exception as e:
     print(f"Error configuring Gemini: {e}")
 
 # Constants
-MOTION_THRESHOLD = 5000  # Number of pixels that need to change to be considered motion
+MOTION_THRESHOLD = 300   # Number of pixels (at MOTION_SIZE) that need to change to be considered motion
+MOTION_SIZE = (160, 120) # Frames are downscaled to this size before motion detection
+PIXEL_DELTA = 25         # Per-pixel intensity change that counts as "changed"
 TIME_THRESHOLD = 5.0     # Seconds of stillness required
 CAM_ID = 0               # Default camera
 MIN_AI_INTERVAL = 15  # Minimum seconds between API calls
+FRAME_WIDTH = 640        # Requested capture resolution
+FRAME_HEIGHT = 480
+FRAME_FPS = 30
+JPEG_QUALITY = 80        # Quality of the image uploaded to Gemini
+MAX_UPLOAD_EDGE = 1024   # Longest edge (px) of the image uploaded to Gemini
+UI_BAR_HEIGHT = 110      # Height of the status bar drawn at the top of the frame
+USE_OPENCL = False       # Run motion detection on UMat (OpenCV T-API); only pays off for large MOTION_SIZE
+MOTION_SAMPLE_EVERY = 6  # Run motion detection on every Nth frame (~5 Hz at 30fps)
 
 # Steps
 STEPS = [
@@ -43,6 +66,24 @@ STEPS = [
   }
 ]
 
+# Static instructor prompt, sent first in every request to keep the prompt prefix identical across calls
+INSTRUCTOR_PROMPT = """
+You are an expert electronics instructor checking a student's Arduino circuit.
+
+Analyze the provided image. Does the wiring match the instruction?
+Ignore unrelated objects.
+
+Respond with valid JSON ONLY:
+{
+  "status": "correct" | "partial" | "incorrect",
+  "confidence": <float 0.0-1.0>,
+  "feedback": "<short, clear guidance string>"
+}
+"""
+
+# Fallback for responses that wrap the JSON object in extra text
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+
 # Colors (BGR)
 GREEN = (0, 255, 0)
 YELLOW = (0, 255, 255)
@@ -50,19 +91,57 @@ RED = (0, 0, 255)
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
 
+if HAS_NUMBA:
+    @njit(cache=True)
+    def motion_count(prev, cur, thr):
+        """Count pixels whose absolute difference exceeds thr, in a single pass"""
+        prev = prev.ravel()
+        cur = cur.ravel()
+        s = 0
+        for i in range(prev.size):
+            if abs(int(cur[i]) - int(prev[i])) > thr:
+                s += 1
+        return s
+else:
+    def motion_count(prev, cur, thr):
+        """Fallback when numba is unavailable: absdiff + threshold + count"""
+        frame_delta = cv2.absdiff(prev, cur)
+        thresh = cv2.threshold(frame_delta, thr, 255, cv2.THRESH_BINARY)[1]
+        return cv2.countNonZero(thresh)
+
 class ArduinoAssistant:
     def __init__(self):
         self.cap = cv2.VideoCapture(CAM_ID)
         self.prev_frame = None
+        self._small = None  # Motion-detection work buffers, allocated on first frame
+        self._gray = None
+        self._blur = None
+        self._use_umat = USE_OPENCL and cv2.ocl.haveOpenCL()
+        self.motion_frame_counter = 0
+        # Compile (or load the cached) motion_count kernel now rather than on the first displayed frame
+        motion_count(np.zeros((1, 1), np.uint8), np.zeros((1, 1), np.uint8), PIXEL_DELTA)
+        self.last_motion_score = 0
         self.last_motion_time = time.time()
         self.current_step_idx = 0
         self.state = "MOVING" # MOVING, STEADY, ANALYZING, FEEDBACK
         self.feedback_data = None
-        self.analyzing_thread = None
+        self._ai_exec = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._ai_future = None  # Pending analyze_image call, polled from run()
         self.latest_frame = None
-        self.last_ai_call = 0  # Timestamp of last AI call
+        self._next_ai_allowed_at = 0.0  # Timestamp when the MIN_AI_INTERVAL cooldown ends
         self.steady_captured = False  # True = this steady event already triggered AI
         self.quota_exhausted = False  # True = daily quota exhausted, stop all API calls
+        self.success_start = None  # Timestamp when a "correct" result started showing
+        self._model = genai.GenerativeModel('gemini-2.5-flash') if API_KEY else None
+        self._ui_key = None  # Inputs the cached status bar was rendered from
+        self._ui_bg = None
+        self._jpeg = None  # TurboJPEG encoder, falls back to cv2.imencode if unavailable
+
+        if HAS_TURBOJPEG:
+            try:
+                self._jpeg = TurboJPEG()
+            except Exception as e:
+                print(f"TurboJPEG unavailable, using OpenCV encoder: {e}")
         
         # Check if camera opened successfully
         if not self.cap.isOpened():
@@ -72,75 +151,145 @@ class ArduinoAssistant:
         if not self.cap.isOpened():
             raise ValueError("Could not open video device")
 
+        # Request MJPG first (changing the fourcc can renegotiate the size), then a modest
+        # resolution and a 1-frame buffer so frames don't queue up while analyzing
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+        self.cap.set(cv2.CAP_PROP_FPS, FRAME_FPS)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        # Frames are grabbed on a background thread; only the newest one is kept
+        self._frame_lock = threading.Lock()
+        self._frame_ready = threading.Event()
+        self._latest = None
+        self._capture_running = False
+        self._capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+
+    def _capture_loop(self):
+        """Threaded producer: keep overwriting the latest-frame slot"""
+        # Reading continuously (with CAP_PROP_BUFFERSIZE=1) keeps the driver buffer drained,
+        # even while ANALYZING, so no frames queue up in the driver. Keeping prev_frame
+        # itself recent is handled by sampling motion during ANALYZING in run().
+        while self._capture_running:
+            ret, frame = self.cap.read()
+            with self._frame_lock:
+                self._latest = frame if ret else None
+                self._frame_ready.set()
+            if not ret:
+                break
+        # Released here so it can never race with an in-flight read()
+        self.cap.release()
+
+    def read_frame(self):
+        """Block until a new frame is available. Returns None if capture failed."""
+        self._frame_ready.wait()
+        with self._frame_lock:
+            frame = self._latest
+            self._latest = None
+            self._frame_ready.clear()
+        return frame
+
+    def awaiting_retry(self):
+        """True while non-correct feedback is shown and we wait for the user to move"""
+        return bool(
+            self.state == "FEEDBACK"
+            and self.feedback_data
+            and self.feedback_data.get("status") != "correct"
+        )
+
     def get_motion_score(self, frame):
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (21, 21), 0)
+        if self._use_umat:
+            return self._get_motion_score_umat(frame)
+
+        # Motion detection doesn't need full resolution; work buffers are reused across frames
+        if self._gray is None:
+            w, h = MOTION_SIZE
+            self._small = np.empty((h, w, 3), np.uint8)
+            self._gray = np.empty((h, w), np.uint8)
+            self._blur = np.empty((h, w), np.uint8)
+
+        cv2.resize(frame, MOTION_SIZE, dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        cv2.GaussianBlur(self._gray, (5, 5), 0, dst=self._blur)
         
+        if self.prev_frame is None:
+            self.prev_frame, self._blur = self._blur, np.empty_like(self._blur)
+            return 100000 # Force moving on first frame
+
+        motion_score = motion_count(self.prev_frame, self._blur, PIXEL_DELTA)
+        
+        # Ping-pong: this frame becomes prev, the old prev buffer is overwritten next time
+        self.prev_frame, self._blur = self._blur, self.prev_frame
+        return motion_score
+
+    def _get_motion_score_umat(self, frame):
+        """Same pipeline as get_motion_score, run through OpenCL; prev_frame holds a UMat"""
+        small = cv2.resize(cv2.UMat(frame), MOTION_SIZE, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (5, 5), 0)
+
         if self.prev_frame is None:
             self.prev_frame = gray
             return 100000 # Force moving on first frame
 
         frame_delta = cv2.absdiff(self.prev_frame, gray)
-        thresh = cv2.threshold(frame_delta, 25, 255, cv2.THRESH_BINARY)[1]
-        motion_score = np.sum(thresh) / 255
-        
+        thresh = cv2.threshold(frame_delta, PIXEL_DELTA, 255, cv2.THRESH_BINARY)[1]
+        motion_score = cv2.countNonZero(thresh)
+
         self.prev_frame = gray
         return motion_score
 
     def analyze_image(self, frame, step):
-        """Threaded function to call Gemini"""
+        """Runs on the AI executor; returns the feedback dict for run() to apply"""
         try:
             if not API_KEY:
                 # Simulate if no key
                 time.sleep(2)
-                self.feedback_data = {"status": "correct", "confidence": 1.0, "feedback": "Simulated Success (No API Key)"}
-                self.state = "FEEDBACK"
-                return
+                return {"status": "correct", "confidence": 1.0, "feedback": "Simulated Success (No API Key)"}
+
+            # Gemini resizes internally, so don't upload more pixels than it uses
+            h, w = frame.shape[:2]
+            scale = MAX_UPLOAD_EDGE / max(h, w)
+            if scale < 1.0:
+                frame = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
 
             # Encode image to bytes
-            success, buffer = cv2.imencode('.jpg', frame)
-            if not success:
-                print("Failed to encode image")
-                self.feedback_data = {"status": "error", "feedback": "Camera error"}
-                self.state = "FEEDBACK"
-                return
-
-            # Prepare prompt
-            prompt = f"""
-            You are an expert electronics instructor checking a student's Arduino circuit.
-            
-            Current Step Instruction: "{step['instruction']}"
-            Expected Visual: "{step['expected']}"
-            
-            Analyze the provided image. Does the wiring match the instruction?
-            Ignore unrelated objects.
-            
-            Respond with valid JSON ONLY:
-            {{
-              "status": "correct" | "partial" | "incorrect",
-              "confidence": <float 0.0-1.0>,
-              "feedback": "<short, clear guidance string>"
-            }}
-            """
-            
-            model = genai.GenerativeModel('gemini-2.5-flash')
+            if self._jpeg is not None:
+                image_data = self._jpeg.encode(frame, quality=JPEG_QUALITY)
+            else:
+                success, buffer = cv2.imencode('.jpg', frame, [
+                    int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY,
+                    int(cv2.IMWRITE_JPEG_OPTIMIZE), 0,
+                ])
+                if not success:
+                    print("Failed to encode image")
+                    return {"status": "error", "feedback": "Camera error"}
+                image_data = buffer.tobytes()
+
+            # Prepare prompt (only the step details change between calls)
+            step_prompt = (
+                f"Current Step Instruction: \"{step['instruction']}\"\n"
+                f"Expected Visual: \"{step['expected']}\""
+            )
             
             image_parts = [
-                {"mime_type": "image/jpeg", "data": buffer.tobytes()}
+                {"mime_type": "image/jpeg", "data": image_data}
             ]
             
             # Single API call - no retries
             try:
-                response = model.generate_content([prompt, image_parts[0]])
+                response = self._model.generate_content(
+                    [INSTRUCTOR_PROMPT, step_prompt, image_parts[0]],
+                    generation_config={"response_mime_type": "application/json"}
+                )
             except exceptions.ResourceExhausted:
                 print("Quota exceeded. Daily limit reached - stopping all API calls.")
                 self.quota_exhausted = True  # Lock all future API calls
-                self.feedback_data = {
+                return {
                     "status": "error",
                     "feedback": "Daily quota exhausted. Try tomorrow."
                 }
-                self.state = "FEEDBACK"
-                return
             except Exception as e:
                 print(f"API Error: {e}")
                 raise
@@ -148,54 +297,53 @@ class ArduinoAssistant:
             if not response:
                 raise Exception("Failed to get response from AI")
             
-            # Parse JSON
+            # Parse JSON (normally the whole response, since we request application/json)
             text = response.text
-            match = re.search(r'\{.*\}', text, re.DOTALL)
-            if match:
-                json_str = match.group(0)
-                try:
-                    result = json.loads(json_str)
-                    self.feedback_data = result
-                except json.JSONDecodeError:
-                    print("JSON Decode Error:", text)
-                    self.feedback_data = {
-                        "status": "partial", 
-                        "confidence": 0.0, 
-                        "feedback": "Could not understand AI response. Try again."
-                    }
-            else:
+            try:
+                result = json.loads(text)
+            except json.JSONDecodeError:
+                result = None
+            if isinstance(result, dict):
+                return result
+            
+            # Without a schema the reply may still be a list or bare string; fall back to
+            # extracting the first object from the text
+            match = _JSON_RE.search(text)
+            if not match:
                 print("No JSON found in response:", text)
-                self.feedback_data = {
+                return {
                     "status": "error",
                     "feedback": "Invalid AI response format."
                 }
+            try:
+                return json.loads(match.group(0))
+            except json.JSONDecodeError:
+                print("JSON Decode Error:", text)
+                return {
+                    "status": "partial", 
+                    "confidence": 0.0, 
+                    "feedback": "Could not understand AI response. Try again."
+                }
                 
         except Exception as e:
             print(f"AI Error: {e}")
-            self.feedback_data = {
+            return {
                 "status": "error", 
                 "confidence": 0.0, 
                 "feedback": f"AI Error: {str(e)}"
             }
-        
-        self.state = "FEEDBACK"
 
-    def draw_ui(self, frame, motion_score):
+    def draw_ui(self, frame, motion_score, now):
         h, w = frame.shape[:2]
         
-        # 1. Status Bar Background
-        cv2.rectangle(frame, (0, 0), (w, 110), BLACK, -1)
-        
-        # 2. Step Info
+        # 1. Step Info
         if self.current_step_idx < len(STEPS):
             step = STEPS[self.current_step_idx]
             text = f"Step {step['id']}: {step['instruction']}"
         else:
             text = "All steps completed!"
-            
-        cv2.putText(frame, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, WHITE, 2)
         
-        # 3. State Indicator & Feedback
+        # 2. State Indicator & Feedback
         status_color = WHITE
         status_text = self.state
         feedback_text = None  # Persistent feedback shown below status
@@ -238,23 +386,31 @@ class ArduinoAssistant:
             elif self.steady_captured:
                 status_text = "Done. Move to retry."
                 status_color = YELLOW
-            elif time.time() - self.last_ai_call < MIN_AI_INTERVAL:
-                remaining = int(MIN_AI_INTERVAL - (time.time() - self.last_ai_call))
+            elif now < self._next_ai_allowed_at:
+                remaining = int(self._next_ai_allowed_at - now)
                 status_text = f"Cooldown ({remaining}s)..."
                 status_color = YELLOW
             else:
                 status_text = "Hold steady..."
                 status_color = GREEN
 
-        cv2.putText(frame, status_text, (10, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.6, status_color, 2)
-        
-        # Show persistent feedback below status (keeps showing until new feedback arrives)
-        if feedback_text:
-            cv2.putText(frame, feedback_text, (10, 95), cv2.FONT_HERSHEY_SIMPLEX, 0.5, feedback_color, 2)
+        # 3. Status Bar, only re-rendered when its contents change
+        ui_key = (w, text, status_text, status_color, feedback_text, feedback_color)
+        if ui_key != self._ui_key:
+            self._ui_key = ui_key
+            self._ui_bg = np.zeros((UI_BAR_HEIGHT, w, 3), np.uint8)  # BLACK background
+            cv2.putText(self._ui_bg, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, WHITE, 2)
+            cv2.putText(self._ui_bg, status_text, (10, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.6, status_color, 2)
+            
+            # Show persistent feedback below status (keeps showing until new feedback arrives)
+            if feedback_text:
+                cv2.putText(self._ui_bg, feedback_text, (10, 95), cv2.FONT_HERSHEY_SIMPLEX, 0.5, feedback_color, 2)
+
+        frame[0:UI_BAR_HEIGHT] = self._ui_bg
 
         # 4. Stability Progress Bar (Bottom)
         if self.state in ["MOVING", "STEADY"]:
-            time_still = time.time() - self.last_motion_time
+            time_still = now - self.last_motion_time
             progress = min(time_still / TIME_THRESHOLD, 1.0)
             bar_width = int(w * progress)
             bar_color = GREEN if progress >= 1.0 else YELLOW
@@ -266,18 +422,30 @@ class ArduinoAssistant:
         print("Starting Arduino Assistant...")
         print("Press 'q' to quit.")
         
+        self._capture_running = True
+        self._capture_thread.start()
+
         while True:
-            ret, frame = self.cap.read()
-            if not ret:
+            frame = self.read_frame()
+            if frame is None:
                 print("Failed to grab frame")
                 break
             
             # Mirror frame for better UX
             frame = cv2.flip(frame, 1)
-            self.latest_frame = frame.copy()
+            self.latest_frame = frame  # Copied only when handed to the AI thread
             
-            # Motion Detection
-            motion = self.get_motion_score(frame)
+            # Motion Detection (only in states that consume the score)
+            track_motion = self.state in ("MOVING", "STEADY") or self.awaiting_retry()
+            # While ANALYZING, keep sampling so prev_frame is fresh when feedback arrives,
+            # but ignore the score
+            if track_motion or self.state == "ANALYZING":
+                self.motion_frame_counter += 1
+                if self.prev_frame is None or self.motion_frame_counter % MOTION_SAMPLE_EVERY == 0:
+                    score = self.get_motion_score(frame)
+                    if track_motion:
+                        self.last_motion_score = score
+            motion = self.last_motion_score if track_motion else 0
             
             # State Machine
             now = time.time()
@@ -299,7 +467,7 @@ class ArduinoAssistant:
                 elif self.steady_captured:
                     # Already sent for this steady event, wait for motion
                     pass
-                elif time.time() - self.last_ai_call < MIN_AI_INTERVAL:
+                elif now < self._next_ai_allowed_at:
                     # Cooldown active, wait (don't retry)
                     pass
                 else:
@@ -309,12 +477,10 @@ class ArduinoAssistant:
                     if self.current_step_idx < len(STEPS):
                         step = STEPS[self.current_step_idx]
                         self.state = "ANALYZING"
-                        self.last_ai_call = time.time()
-                        self.analyzing_thread = threading.Thread(
-                            target=self.analyze_image, 
-                            args=(self.latest_frame, step)
+                        self._next_ai_allowed_at = now + MIN_AI_INTERVAL
+                        self._ai_future = self._ai_exec.submit(
+                            self.analyze_image, self.latest_frame.copy(), step
                         )
-                        self.analyzing_thread.start()
                     else:
                         self.state = "FEEDBACK"
                         self.feedback_data = {"status": "correct", "feedback": "Complete!"}
@@ -325,8 +491,11 @@ class ArduinoAssistant:
                     self.last_motion_time = now
             
             elif self.state == "ANALYZING":
-                # Just wait for thread to update state to FEEDBACK
-                pass
+                # Wait for the AI call to finish
+                if self._ai_future and self._ai_future.done():
+                    self.feedback_data = self._ai_future.result()
+                    self._ai_future = None
+                    self.state = "FEEDBACK"
             
             elif self.state == "FEEDBACK":
                 # If correct, wait a bit then move to next step
@@ -337,39 +506,45 @@ class ArduinoAssistant:
                      # Let's give it a moment to show the success message, then advance
                      cv2.putText(frame, "Next step in 3s...", (10, 130), cv2.FONT_HERSHEY_SIMPLEX, 0.7, GREEN, 2)
                      
-                     if not hasattr(self, 'success_start'):
-                         self.success_start = time.time()
+                     if self.success_start is None:
+                         self.success_start = now
                      
-                     if time.time() - self.success_start > 3.0:
+                     if now - self.success_start > 3.0:
                          self.current_step_idx += 1
                          self.state = "MOVING"
                          self.feedback_data = None
-                         self.last_motion_time = time.time()
-                         delattr(self, 'success_start')
+                         self.prev_frame = None  # Motion was not tracked while showing feedback
+                         self.last_motion_time = now
+                         self.success_start = None
                          
                 elif self.feedback_data and self.feedback_data.get("status") in ["incorrect", "partial", "error"]:
                     # If incorrect, go back to monitoring when user moves
                     # Keep feedback_data so it stays visible until new feedback arrives
                     if motion > MOTION_THRESHOLD:
                          self.state = "MOVING"
-                         self.last_motion_time = time.time()
+                         self.last_motion_time = now
 
             # Draw UI
-            frame = self.draw_ui(frame, motion)
+            frame = self.draw_ui(frame, motion, now)
             
             cv2.imshow('Arduino Assistant', frame)
             
-            key = cv2.waitKey(1) & 0xFF
+            # Nothing depends on frame rate while waiting on the AI or showing success
+            idle = self.state == "ANALYZING" or (self.state == "FEEDBACK" and not self.awaiting_retry())
+            key = cv2.waitKey(30 if idle else 1) & 0xFF
             if key == ord('q'):
                 break
             elif key == ord('r'):
                 # Reset state
                 self.state = "MOVING"
                 self.feedback_data = None
-                self.last_motion_time = time.time()
+                self.prev_frame = None
+                self.last_motion_time = now
                 print("Reset. Ready for next capture.")
                 
-        self.cap.release()
+        self._ai_exec.shutdown(wait=False)
+        self._capture_running = False
+        self._capture_thread.join(timeout=1.0)  # The capture thread releases the camera on exit
         cv2.destroyAllWindows()
 
 if __name__ == "__main__":